@@ -2,13 +2,19 @@
 Salt cloud module
 """
 
+import contextvars
+import functools
 import logging
+import random
+import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import ip_interface
-from pprint import pprint
 
 from salt import config
+from salt.exceptions import SaltCloudExecutionFailure
 from salt.exceptions import SaltCloudExecutionTimeout
 from salt.exceptions import SaltCloudNotFound
 from salt.exceptions import SaltCloudSystemExit
@@ -16,10 +22,19 @@ from salt.exceptions import SaltCloudSystemExit
 # from salt.utils.minions import HAS_RANGE  # pylint disable=unused-import
 try:
     import requests  # pylint: disable=import-error
+    from requests.adapters import HTTPAdapter  # pylint: disable=import-error
+    from urllib3.util.retry import Retry  # pylint: disable=import-error
 
     HAS_REQUESTS = True
 except:  # pylint: disable=bare-except
     HAS_REQUESTS = False
+# Faster JSON decoding of large API responses, if available
+try:
+    import orjson  # pylint: disable=import-error
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 # Disable InsecureRequestWarning generated on python > 2.6
 try:
     from requests.packages.urllib3 import disable_warnings  # pylint: disable=no-name-in-module
@@ -32,8 +47,32 @@ log = logging.getLogger(__name__)
 
 __virtualname__ = "proxmox_v9x"
 
+# Shared HTTP session so API calls reuse pooled keep-alive connections
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# Headers for requests sending form data (POST, PUT, DELETE)
+_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+# Max number of concurrent API requests, also used as the connection pool size
+_MAX_WORKERS = 16
+
+# Short-lived cache of the cluster VMs per provider, indexed by name and vmid
+_VM_INDEX_TTL = 2
+_VM_INDEX_CACHE = {}
+_VM_INDEX_LOCKS = {}
+_VM_INDEX_LOCK = threading.Lock()
+
+# Upper bound in seconds for the exponential backoff between API polls
+_MAX_POLL_INTERVAL = 10
+
+# Matches the "ip" setting of a network config stringlist, e.g. "name=eth0,ip=10.0.0.2/24"
+_IP_RE = re.compile(r"(?:^|,)\s*ip=([^,]+)")
+
 
 def __virtual__():
+    _reset_config_cache()
+
     if get_configured_provider() is False:
         return False
     if get_dependencies() is False:
@@ -53,13 +92,32 @@ def get_configured_provider():
     """
     Return the first configured instance.
     """
+    return _get_configured_provider(_get_active_provider_name() or __virtualname__)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_configured_provider(provider_name):
+    """
+    Return the configuration of the named provider, cached per provider name
+    """
     return config.is_provider_configured(
         __opts__,
-        _get_active_provider_name() or __virtualname__,
+        provider_name,
         ("user", "tokenid", "token", "url"),
     )
 
 
+def _reset_config_cache():
+    """
+    Drop the cached provider configuration, e.g. after ``__opts__`` changed
+    """
+    _get_configured_provider.cache_clear()
+    _get_provider_url.cache_clear()
+    _get_provider_api_token.cache_clear()
+    _get_provider_api_base.cache_clear()
+    _get_provider_authorization.cache_clear()
+
+
 def get_cloud_config():
     """
     Return the cloud configuration.
@@ -92,6 +150,8 @@ def clone(kwargs=None, call=None):  # pylint: disable=unused-argument
     kwargs
         Parametres to be passed as dict
 
+    Returns the UPID of the Proxmox clone task.
+
     For required and optional parameters please check the Proxmox API documentation:
            * ``https://<PROXMOX_URL>/pve-docs/api-viewer/index.html#/nodes/{node}/qemu/{vmid}/clone``
            * ``https://<PROXMOX_URL>/pve-docs/api-viewer/index.html#/nodes/{node}/lxc/{vmid}/clone``
@@ -124,9 +184,13 @@ def clone(kwargs=None, call=None):  # pylint: disable=unused-argument
     # Get the VM Name from Proxmox by vmid (int)
     vm = _get_vm_by_id(vmid)
 
-    _query("POST", f"nodes/{vm['node']}/{vm['type']}/{vmid}/clone", kwargs)
+    upid = _query("POST", f"nodes/{vm['node']}/{vm['type']}/{vmid}/clone", kwargs)
+    _invalidate_vm_index()
 
-    raise SaltCloudExecutionTimeout("Timeout to wait for VM cloning reached")
+    if upid is None:
+        raise SaltCloudExecutionFailure(f"Failed to clone the VM with vmid '{vmid}'.")
+
+    return upid
 
 
 def reconfigure(name=None, kwargs=None):
@@ -171,7 +235,10 @@ def destroy(name=None, kwargs=None, call=None):
             "The destroy action must be called with -d, --destroy, -a or --action."
         )
 
-    stop(name, kwargs, call)
+    # Resolve the VM once and reuse it for stopping, waiting and deleting
+    vm = _get_vm_by_name(name)
+
+    upid = _set_vm_status(name, "stop", kwargs, vm=vm)
 
     __utils__["cloud.fire_event"](  # pylint: disable=undefined-variable
         "event",
@@ -182,11 +249,13 @@ def destroy(name=None, kwargs=None, call=None):
         transport=__opts__["transport"],  # pylint: disable=undefined-variable
     )
 
-    vm = _get_vm_by_name(name)
-
-    _wait_for_vm_status(name, "stopped", timeout=20, interval=2)
+    if upid:
+        _wait_for_task(upid, timeout=20, interval=2)
+    else:
+        _wait_for_vm_status(name, "stopped", timeout=20, interval=2, vm=vm)
 
     _query("DELETE", f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}", kwargs)
+    _invalidate_vm_index()
 
     __utils__["cloud.fire_event"](  # pylint: disable=undefined-variable
         "event",
@@ -257,12 +326,11 @@ def avail_images(kwargs=None, call=None):
 
     ret = {}
     for location in avail_locations():
-        print("location: ", location)
+        log.debug("Listing images of location %s", location)
         ret[location] = {}
         for item in _query("GET", f"nodes/{location}/storage/{storage}/content"):
             ret[location][item["volid"]] = item
             # TODO: filter to actual images. what is an imagetype? images, vztmpl, iso
-    print("ret[...]:", ret)
     return ret
 
 
@@ -281,24 +349,23 @@ def list_nodes(call=None):
     if call is None:
         call = None
 
-    vms = _query("GET", "cluster/resources?type=vm", None)
-
-    ret = {}
-    for vm in vms:
-        name = vm["name"]
+    vms = _list_vms()
 
-        # Add extra information from the VM to the output
-        ret[name] = {}
-        ret[name]["id"] = str(vm["vmid"])
-        ret[name]["state"] = str(vm["status"])
-        ret[name]["uptime"] = str(vm["uptime"])
-        ret[name]["maxcpu"] = str(vm["maxcpu"])
-        ret[name]["memory"] = str(int(vm["maxmem"] / 1024 / 1000))
-        ret[name]["disk"] = str(int(vm["maxdisk"] / 1024 / 1024 / 1000))
+    return {vm["name"]: _summarize_vm(vm) for vm in vms if vm.get("name")}
 
-        # config = _query("GET", f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/config")
 
-    return ret
+def _summarize_vm(vm):
+    """
+    Return the sparse details of a VM from ``cluster/resources`` as shown by list_nodes
+    """
+    return {
+        "id": str(vm["vmid"]),
+        "state": str(vm["status"]),
+        "uptime": str(vm["uptime"]),
+        "maxcpu": str(vm["maxcpu"]),
+        "memory": str(int(vm["maxmem"] / 1024 / 1000)),
+        "disk": str(int(vm["maxdisk"] / 1024 / 1024 / 1000)),
+    }
 
 
 def list_nodes_full(call=None):
@@ -317,16 +384,40 @@ def list_nodes_full(call=None):
             "The list_nodes_full function must be called with -f or --function."
         )
 
-    # vms = _query("GET", "cluster/resources", data={"type": "vm"})
-    vms = _query("GET", "cluster/resources?type=vm", None)
+    return _list_nodes_full()
+
+
+def _list_nodes_full(with_config=True):
+    """
+    Return the VMs of the cluster by name, as shown by list_nodes_full
+
+    with_config
+        Fetch the config of every VM into its ``config`` field. Default: True
+    """
+    vms = _list_vms()
+
+    if not with_config:
+        return {vm["name"]: dict(vm) for vm in vms if vm.get("name")}
 
     ret = {}
-    for vm in vms:
-        name = vm["name"]
-        config = _query("GET", f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/config")
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        # Fetch the VM configs concurrently, each in a copy of the current
+        # context so the loader dunders remain available in the worker threads
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run,
+                _query,
+                "GET",
+                f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/config",
+            ): vm
+            for vm in vms
+            if vm.get("name")
+        }
+        for future, vm in futures.items():
+            name = vm["name"]
 
-        ret[name] = vm
-        ret[name]["config"] = config
+            ret[name] = dict(vm)
+            ret[name]["config"] = future.result()
 
     return ret
 
@@ -335,11 +426,13 @@ def list_nodes_select(call=None):
     """
     Return a list of the VMs that are managed by the provider, with select fields
 
-    Not implemented yet
+    The config of every VM is only fetched if the ``config`` field is selected.
     """
+    selection = __opts__["query.selection"]
+
     return __utils__["cloud.list_nodes_select"](  # pylint: disable=undefined-variable
-        list_nodes_full(),
-        __opts__["query.selection"],
+        _list_nodes_full(with_config="config" in selection),
+        selection,
         call,
     )
 
@@ -357,14 +450,18 @@ def show_instance(name=None, call=None):
 
         salt-cloud -a show_instance vm_name
     """
-    for k, v in list_nodes_full().items():
-        if k == name:
-            return v
-
     if call is None:
         call = None
 
-    raise SaltCloudNotFound(f"The specified VM named '{name}' could not be found.")
+    # Only fetch the config of the requested VM instead of the whole cluster
+    vm = _lookup_vm("by_name", name)
+    if vm is None:
+        raise SaltCloudNotFound(f"The specified VM named '{name}' could not be found.")
+
+    ret = dict(vm)
+    ret["config"] = _query("GET", f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/config")
+
+    return ret
 
 
 def start(name=None, kwargs=None, call=None):
@@ -382,9 +479,18 @@ def start(name=None, kwargs=None, call=None):
         * ``https://<PROXMOX_URL>/pve-docs/api-viewer/index.html#/nodes/{node}/qemu/{vmid}/status/start``
 
     """
-    _set_vm_status(name, "start", kwargs)
+    upid = _set_vm_status(name, "start", kwargs)
 
-    _wait_for_vm_status(name, "running", timeout=300, interval=1)
+    if upid:
+        try:
+            _wait_for_task(upid, timeout=300, interval=1)
+        except SaltCloudExecutionFailure as exc:
+            # Proxmox fails the start task of a running VM, which is what we want anyway
+            if "already running" not in str(exc):
+                raise
+            log.debug("VM %s is already running", name)
+    else:
+        _wait_for_vm_status(name, "running", timeout=300, interval=1)
 
     if call is None:
         call = None
@@ -419,7 +525,6 @@ def stop(name=None, kwargs=None, call=None):
     if call != "action":
         raise SaltCloudSystemExit("The stop action must be called with -a or --action.")
 
-    print('_set_vm_status(name, "stop", kwargs)')
     _set_vm_status(name, "stop", kwargs)
 
     return {
@@ -452,9 +557,12 @@ def shutdown(name=None, kwargs=None, call=None):
     if call != "action":
         raise SaltCloudSystemExit("The shutdown action must be called with -a or --action.")
 
-    _set_vm_status(name, "shutdown", kwargs)
+    upid = _set_vm_status(name, "shutdown", kwargs)
 
-    _wait_for_vm_status(name, "stopped", timeout=300, interval=1)
+    if upid:
+        _wait_for_task(upid, timeout=300, interval=1)
+    else:
+        _wait_for_vm_status(name, "stopped", timeout=300, interval=1)
 
     return {
         "success": True,
@@ -463,97 +571,230 @@ def shutdown(name=None, kwargs=None, call=None):
     }
 
 
-def _query(method, path, data=None):
+def _get_session():
     """
-    Query the Proxmox API
+    Return the shared requests session, creating it on first use
+
+    The session is shared between providers, so the Authorization header is
+    passed with each request instead of being set on the session.
     """
+    global _SESSION  # pylint: disable=global-statement
+
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=_MAX_WORKERS,
+                max_retries=Retry(total=3, backoff_factor=0.2),
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(
+                {
+                    "Accept": "application/json",
+                    "User-Agent": "salt-cloud-proxmox",
+                }
+            )
+            _SESSION = session
 
-    base_url = _get_url()
-    api_token = _get_api_token()
+    return _SESSION
 
-    url = f"{base_url}/api2/json/{path}"
 
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": "salt-cloud-proxmox",
-        "Authorization": f"PVEAPIToken={api_token}",
-    }
+def _query(method, path, data=None, allow_500=False):
+    """
+    Query the Proxmox API
 
-    response = None
+    allow_500
+        Return None instead of raising when the API responds with HTTP 500, which is
+        what Proxmox does for VM features (e.g. the guest agent) that aren't ready yet.
+    """
 
-    if method == "RAWGET":
-        # This method is used to check if Proxmox'es VM features are working, but response with 500 until they do
-        print("_query RAW GET: ", f"{url} headers={headers} data={data}")
-        response = requests.get(
-            url=url,
-            headers=headers,
-            data=data,
-            timeout=10,
-        )
-        if response.status_code != 500:
-            return response
-        else:
-            return response.status_code
+    provider_name = _get_active_provider_name() or __virtualname__
+    session = _get_session()
+
+    url = f"{_get_provider_api_base(provider_name)}/{path}"
+    headers = {"Authorization": _get_provider_authorization(provider_name)}
 
     if method == "GET":
-        # print("_query GET: ", f"{url} headers={headers} data={data}")
+        log.debug("_query GET %s data=%s", url, data)
         try:
-            response = requests.get(
+            response = session.get(
                 url=url,
                 headers=headers,
                 data=data,
                 timeout=10,
             )
-        except requests.exceptions.HTTPError as http_error_code:
-            print("_query response status: ", pprint(response))
-            print("error: ", http_error_code)
         except requests.exceptions.RequestException:
-            log.error("Error in query to %s\n%s\n%s\n", url, response, data)
+            log.error("Error in %s query to %s", method, url, exc_info=True)
             return None
 
     else:  # for POST, DELETE etc.
-        # print("_query: ", f"method={method} headers={headers} data={data}")
+        # The form data isn't logged as it may carry secrets like cipassword or sshkeys
+        log.debug("_query %s %s", method, url)
         try:
-            headers["Content-Type"] = "application/x-www-form-urlencoded"
-            response = requests.request(
-                method=method, url=url, headers=headers, data=data, timeout=10
+            response = session.request(
+                method=method,
+                url=url,
+                headers={**_FORM_HEADERS, **headers},
+                data=data,
+                timeout=10,
             )
         except requests.exceptions.RequestException:
-            log.error("Error in query to %s\n%s\n%s\n", url, response, data)
+            log.error("Error in %s query to %s", method, url, exc_info=True)
             return None
 
+    if allow_500 and response.status_code == 500:
+        return None
+
     response.raise_for_status()
-    returned_data = response.json()
+    if HAS_ORJSON:
+        returned_data = orjson.loads(response.content)
+    else:
+        returned_data = response.json()
     return returned_data.get("data")
 
 
-def _get_url():
+@functools.lru_cache(maxsize=1)
+def _get_provider_url(provider_name):
     """
-    Returns the configured Proxmox URL
+    Returns the Proxmox URL of the named provider, cached per provider name
     """
     return config.get_cloud_config_value(
-        "url", get_configured_provider(), __opts__, search_global=False
+        "url", _get_configured_provider(provider_name), __opts__, search_global=False
     )
 
 
-def _get_api_token():
+@functools.lru_cache(maxsize=1)
+def _get_provider_api_base(provider_name):
     """
-    Returns the API token for the Proxmox API
+    Returns the base URL of the JSON API of the named provider, cached per provider name
     """
-    username = config.get_cloud_config_value(
-        "user", get_configured_provider(), __opts__, search_global=False
-    )
-    token = config.get_cloud_config_value(
-        "token", get_configured_provider(), __opts__, search_global=False
-    )
-    tokenid = config.get_cloud_config_value(
-        "tokenid", get_configured_provider(), __opts__, search_global=False
-    )
+    return f"{_get_provider_url(provider_name)}/api2/json"
+
+
+@functools.lru_cache(maxsize=1)
+def _get_provider_api_token(provider_name):
+    """
+    Returns the API token of the named provider, cached per provider name
+    """
+    provider = _get_configured_provider(provider_name)
+    username = config.get_cloud_config_value("user", provider, __opts__, search_global=False)
+    token = config.get_cloud_config_value("token", provider, __opts__, search_global=False)
+    tokenid = config.get_cloud_config_value("tokenid", provider, __opts__, search_global=False)
 
     return f"{username}!{tokenid}={token}"
 
 
-def _get_vm_by_name(name, interval=1, max=2, message=None):
+@functools.lru_cache(maxsize=1)
+def _get_provider_authorization(provider_name):
+    """
+    Returns the Authorization header value of the named provider, cached per provider name
+    """
+    return f"PVEAPIToken={_get_provider_api_token(provider_name)}"
+
+
+def _poll_intervals(interval, max_interval=_MAX_POLL_INTERVAL):
+    """
+    Yield the time in seconds to sleep between API polls
+
+    Starts at ``interval`` and grows by 50% per poll up to ``max_interval``,
+    with up to 10% random jitter so concurrent waiters don't poll in lockstep.
+    """
+    max_interval = max(interval, max_interval)
+    delay = interval
+    while True:
+        yield delay + random.uniform(0, 0.1 * delay)
+        delay = min(max_interval, delay * 1.5)
+
+
+def _wait_for_next_poll(intervals, deadline):
+    """
+    Sleep until the next API poll without sleeping past the deadline
+
+    Returns False once the deadline has passed, i.e. no further poll should be made.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return False
+
+    time.sleep(min(next(intervals), remaining))
+    return True
+
+
+def _get_vm_index(cache_ttl=_VM_INDEX_TTL):
+    """
+    Return the cluster VMs and their index by name and vmid
+
+    The VMs of the active provider are fetched from ``cluster/resources`` and
+    reused for up to ``cache_ttl`` seconds. Pass 0 to force a refresh.
+    """
+    provider_name = _get_active_provider_name() or __virtualname__
+
+    with _get_vm_index_lock(provider_name):
+        index = _VM_INDEX_CACHE.get(provider_name)
+        if index is None or time.time() - index["ts"] >= cache_ttl:
+            vms = _query("GET", "cluster/resources?type=vm", None)
+            if vms is None:
+                # Don't mistake a failed request for a cluster without VMs
+                raise SaltCloudExecutionFailure("Failed to list the VMs of the cluster.")
+
+            by_name = {}
+            by_id = {}
+            for vm in vms:
+                # Keep the first occurrence of duplicated names
+                by_name.setdefault(vm.get("name"), vm)
+                by_id[vm["vmid"]] = vm
+
+            index = {"ts": time.time(), "vms": vms, "by_name": by_name, "by_id": by_id}
+            _VM_INDEX_CACHE[provider_name] = index
+
+        return index
+
+
+def _get_vm_index_lock(provider_name):
+    """
+    Return the lock guarding the VM index of the named provider
+    """
+    with _VM_INDEX_LOCK:
+        return _VM_INDEX_LOCKS.setdefault(provider_name, threading.Lock())
+
+
+def _list_vms(cache_ttl=_VM_INDEX_TTL):
+    """
+    Return the VMs of the cluster as listed by ``cluster/resources``
+
+    The list is shared with the VM lookups and reused for up to ``cache_ttl``
+    seconds, so callers must not modify the returned VMs.
+    """
+    return _get_vm_index(cache_ttl)["vms"]
+
+
+def _invalidate_vm_index():
+    """
+    Force the next VM lookup of the active provider to refresh the VM index
+    """
+    provider_name = _get_active_provider_name() or __virtualname__
+
+    with _get_vm_index_lock(provider_name):
+        _VM_INDEX_CACHE.pop(provider_name, None)
+
+
+def _lookup_vm(key, value):
+    """
+    Return the VM with the given value in the ``by_name`` or ``by_id`` index or None
+
+    A cached index that misses is refreshed once before giving up.
+    """
+    start_time = time.time()
+    index = _get_vm_index()
+    if value not in index[key] and index["ts"] < start_time:
+        index = _get_vm_index(cache_ttl=0)
+
+    return index[key].get(value)
+
+
+def _get_vm_by_name(name, interval=1, max=60, message=None):
     """
     Return VM identified by name
 
@@ -561,10 +802,11 @@ def _get_vm_by_name(name, interval=1, max=2, message=None):
         The name of the VM. Required.
 
     interval
-        The time in seconds to wait between each check
+        The initial time in seconds to wait between each check, backing off exponentially
 
     max
-        The max number of interval's to run
+        The max number of interval's to run, the wait is bounded to ``interval * max`` seconds.
+        Default: 60
 
     message
         A message to display during each wait
@@ -573,24 +815,21 @@ def _get_vm_by_name(name, interval=1, max=2, message=None):
 
         This function will return the first occurrence of a VM matching the given name.
     """
-    counter = 0
-    max = 60
-    while counter < max:
-        # vms = _query("GET", "cluster/resources", {"type": "vm"})
-        vms = _query("GET", "cluster/resources?type=vm", None)
-
-        for vm in vms:
-            if vm["name"] == name:
-                return vm
-        if message is not None:
-            log.info("Waiting for cloning to finish [%d/%d]", counter + 1, max)
-        time.sleep(interval)
-        counter += 1
+    deadline = time.time() + interval * max
+    intervals = _poll_intervals(interval)
+    while True:
+        vm = _lookup_vm("by_name", name)
+        if vm is not None:
+            return vm
+        if message is not None and time.time() < deadline:
+            log.info("Waiting for cloning to finish [%.0fs left]", deadline - time.time())
+        if not _wait_for_next_poll(intervals, deadline):
+            break
 
     raise SaltCloudNotFound(f"The specified VM with name '{name}' could not be found.")
 
 
-def _set_vm_status(name, status, kwargs=None):
+def _set_vm_status(name, status, kwargs=None, vm=None):
     """
     Set the VM status
 
@@ -602,17 +841,63 @@ def _set_vm_status(name, status, kwargs=None):
 
     kwargs
         Addtional parameters to be passed as dict.
+
+    vm
+        The VM as returned by ``_get_vm_by_name``, to skip looking it up again.
+
+    Returns the UPID of the Proxmox task performing the status change.
     """
-    vm = _get_vm_by_name(name)
+    if vm is None:
+        vm = _get_vm_by_name(name)
 
     res = _query("POST", f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/status/{status}", kwargs)
-    pprint(res)
+    log.debug("Set status of VM %s to %s: %s", name, status, res)
+
+    return res
+
+
+def _wait_for_task(upid, timeout=300, interval=0.2):
+    """
+    Wait for a Proxmox task to finish
+
+    Tasks finish as soon as the requested change is done, so this returns with
+    a single extra request for quick tasks instead of polling the VM status.
+
+    upid
+        The UPID of the task, as returned by the API call that started it. Required.
+
+    timeout
+        The timeout in seconds on how long to wait for the task. Default: 300 seconds
+
+    interval
+        The initial interval in seconds at which the API should be queried for updates,
+        backing off exponentially. Default: 0.2 seconds
+    """
+    # UPID:<node>:<pid>:<pstart>:<starttime>:<type>:<id>:<user>:
+    node = upid.split(":")[1]
+
+    deadline = time.time() + timeout
+    intervals = _poll_intervals(interval)
+    while True:
+        response = _query("GET", f"nodes/{node}/tasks/{upid}/status")
+        if response and response["status"] != "running":
+            exitstatus = response.get("exitstatus", "")
+            if exitstatus != "OK" and not exitstatus.startswith("WARNINGS"):
+                raise SaltCloudExecutionFailure(f"Proxmox task {upid} failed: {exitstatus}")
+            return response
+
+        if not _wait_for_next_poll(intervals, deadline):
+            break
+
+    raise SaltCloudExecutionTimeout("Timeout to wait for task reached.")
 
 
 def _wait_for_ip(name, timeout=300, interval=5):
     """
     Wait for the VM's agent to register an IP address for bootstrapping
 
+    The VM is expected to be running already, see ``_wait_for_vm_status``.
+
     name
         The name of the VM. Required
 
@@ -620,36 +905,35 @@ def _wait_for_ip(name, timeout=300, interval=5):
         The timeout in seconds on how long to wait for the task. Default: 300 seconds
 
     interval
-        The interval in seconds at which the API should be queried for updates. Default: 0.2 seconds
+        The initial interval in seconds at which the API should be queried for updates,
+        backing off exponentially. Default: 5 seconds
     """
 
     vm = _get_vm_by_name(name)
-    start_time = time.time()
+    deadline = time.time() + timeout
+    intervals = _poll_intervals(interval)
     log.info("Waiting for VM to get IP address assigned")
-    _wait_for_vm_status(name, "running", timeout=300, interval=5)
-    while time.time() < start_time + timeout:
-        response = _query(
-            "RAWGET",
+    while True:
+        res = _query(
+            "GET",
             f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/agent/network-get-interfaces",
+            allow_500=True,
         )
-        if response != 500:
-            res = _query(
-                "GET",
-                f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/agent/network-get-interfaces",
-            )
+        if res is not None:
             if "result" in res:
                 log.info("Found running qemu guest agent on VM and it has an IP address")
             else:
-                print(
+                log.warning(
                     "No IP address found - perhaps qemu guest agent isn't running on VM template?"
                 )
             return res
-        time.sleep(interval)
+        if not _wait_for_next_poll(intervals, deadline):
+            break
 
     raise SaltCloudExecutionTimeout("Timeout to wait for VM status reached.")
 
 
-def _wait_for_vm_status(name, status, timeout=300, interval=0.2):
+def _wait_for_vm_status(name, status, timeout=300, interval=0.2, vm=None):
     """
     Wait for the VM to reach a given status
 
@@ -663,57 +947,52 @@ def _wait_for_vm_status(name, status, timeout=300, interval=0.2):
         The timeout in seconds on how long to wait for the task. Default: 300 seconds
 
     interval
-        The interval in seconds at which the API should be queried for updates. Default: 0.2 seconds
+        The initial interval in seconds at which the API should be queried for updates,
+        backing off exponentially. Default: 0.2 seconds
+
+    vm
+        The VM as returned by ``_get_vm_by_name``, to skip looking it up again.
     """
-    vm = _get_vm_by_name(name, interval=5, max=12, message="Waiting for VM to be ready")
+    if vm is None:
+        vm = _get_vm_by_name(name, interval=5, max=12, message="Waiting for VM to be ready")
 
-    start_time = time.time()
-    while time.time() < start_time + timeout:
+    deadline = time.time() + timeout
+    intervals = _poll_intervals(interval)
+    while True:
         response = _query("GET", f"nodes/{vm['node']}/{vm['type']}/{vm['vmid']}/status/current")
-        print("status for", f"name={vm['vmid']} vmid={vm['vmid']} status={status}")
-        if response["status"] == status:
+        log.debug("Waiting for VM %s (vmid %s) to be %s", name, vm["vmid"], status)
+        if response and response["status"] == status:
             return True
 
-        time.sleep(interval)
+        if not _wait_for_next_poll(intervals, deadline):
+            break
 
     raise SaltCloudExecutionTimeout("Timeout to wait for VM status reached.")
 
 
-def _stringlist_to_dictionary(input_string):
-    """
-    Convert a stringlist (comma separated settings) to a dictionary
-
-    The result of the string "setting1=value1,setting2=value2" will be a python dictionary:
-
-    {'setting1':'value1','setting2':'value2'}
-    """
-    return dict(item.strip().split("=") for item in input_string.split(",") if item)
-
-
 def _parse_ips(vm_config, vm_type):
     """
     Parse IPs from a Proxmox VM config
     """
-    private_ips = []
-    public_ips = []
-
     ip_configs = []
     if vm_type == "lxc":
         ip_configs = [v for k, v in vm_config.items() if k.startswith("net")]
     else:
         ip_configs = [v for k, v in vm_config.items() if k.startswith("ipconfig")]
 
+    ips = []
     for ip_config in ip_configs:
-        try:
-            ip_with_netmask = _stringlist_to_dictionary(ip_config).get("ip")
-            ip = ip_interface(ip_with_netmask).ip
+        match = _IP_RE.search(ip_config)
+        if match is None:
+            continue
 
-            if ip.is_private:
-                private_ips.append(str(ip))
-            else:
-                public_ips.append(str(ip))
+        try:
+            ips.append(ip_interface(match.group(1)).ip)
         except ValueError:
-            log.error("Ignoring '%s' because it is not a valid IP", ip_with_netmask)
+            log.error("Ignoring '%s' because it is not a valid IP", match.group(1))
+
+    private_ips = [str(ip) for ip in ips if ip.is_private]
+    public_ips = [str(ip) for ip in ips if not ip.is_private]
 
     return private_ips, public_ips
 
@@ -725,11 +1004,9 @@ def _get_vm_by_id(vmid):
     vmid
         The vmid of the VM. Required.
     """
-    # vms = _query("GET", "cluster/resources", {"type": "vm"})
-    vms = _query("GET", "cluster/resources?type=vm", None)
-    for vm in vms:
-        if vm["vmid"] == vmid:
-            return vm
+    vm = _lookup_vm("by_id", vmid)
+    if vm is not None:
+        return vm
 
     raise SaltCloudNotFound(f"The specified VM with vmid '{vmid}' could not be found.")
 
@@ -737,13 +1014,17 @@ def _get_vm_by_id(vmid):
 def create(vm_):
     """
     Create a new VM
+
+    Most of the time is spent waiting for the new VM to boot and be bootstrapped,
+    see ``_finalize``. To provision several VMs at once, run the map file with
+    ``salt-cloud -P``, which calls this function for every VM in parallel.
     """
     image = _get_vm_by_name(vm_.get("image"))
     vm = vm_
     vm["create"] = {}
     vm["create"]["node"] = image["node"]
     vm["create"]["vmid"] = image["vmid"]
-    vm["create"]["newid"] = _query("GET", "/cluster/nextid", None)
+    vm["create"]["newid"] = _query("GET", "cluster/nextid", None)
     vm["create"]["full"] = True
     # vm_["name"] = image["name"]
     newname = vm_["name"]
@@ -764,20 +1045,16 @@ def create(vm_):
     should_clone = bool(clone_options)
 
     if should_clone:
-        clone(call="function", kwargs=clone_options)
+        upid = clone(call="function", kwargs=clone_options)
+
+        # Block on the clone task so the new VM isn't started while still locked
+        _wait_for_task(upid, timeout=600, interval=1)
     else:
         newvmname = vm_["name"]
         vm_["name"] = vm_["image"]
         # vm_["create"].pop("name")
         vm_["create"]["name"] = newvmname
         vm_["create"].pop("full")
-        # TODO: Calculate vmid automatcially
-        vmlist = _query("GET", "cluster/resources?type=vm", None)
-        tmpvmid = []
-        for x in vmlist:
-            tmpvmid.append(x["vmid"])
-        sorted(tmpvmid)
-        vm_["create"]["newid"] = tmpvmid[-1] + 1
         # _query("POST", f"nodes/{vm_['create']['node']}/{type}", vm_["create"])
         res = _query(
             "POST",
@@ -786,7 +1063,18 @@ def create(vm_):
         )
         if res is None:
             sys.exit()
+        _invalidate_vm_index()
+
+        # Block on the clone task so the new VM isn't started while still locked
+        _wait_for_task(res, timeout=600, interval=1)
 
+    return _finalize(vm_)
+
+
+def _finalize(vm_):
+    """
+    Start a newly cloned VM, wait for it to be reachable and bootstrap it
+    """
     start(call="action", name=vm_["create"]["name"])
 
     if vm_.get("ssh_private_key") is None:
@@ -800,9 +1088,6 @@ def create(vm_):
         vm_["username"] = vm_.get("ssh_username")
         vm_["hostname"] = vm_.get("ssh_host")
 
-    # Wait for VM to be running (after clone)
-    _wait_for_vm_status(vm_["create"]["name"], "running", timeout=60, interval=2)
-
     # Wait for VM to have IP address - readable from qemu-guest-agent
     res = _wait_for_ip(vm_["create"]["name"], timeout=10, interval=2)
 
@@ -819,7 +1104,6 @@ def create(vm_):
         if nic["hardware-address"] != "00:00:00:00:00:00":
             ip = nic["ip-addresses"]
             for i in ip:
-                print("i: ", i)
                 if "ip-address-type" in i and i["ip-address-type"] == "ipv4":
                     __opts__["ssh_host"] = i["ip-address"]
 
@@ -832,7 +1116,7 @@ def create(vm_):
         )
         if ssh_answers is True:
             break
-        time.Sleep(1)
+        time.sleep(1)
 
     # Override the default map config setting so new VM's salt minion id is not the templates
     vm_["name"] = vm_["create"]["name"]
@@ -1,7 +1,43 @@
+import logging
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
 import pytest
+import requests
+import salt.utils.cloud
+from requests.adapters import HTTPAdapter
+from salt.exceptions import SaltCloudExecutionFailure
+from salt.exceptions import SaltCloudExecutionTimeout
+from salt.exceptions import SaltCloudNotFound
 
+import saltext.proxmox_v9x.clouds.proxmox_v9x as proxmox
 import saltext.proxmox_v9x.clouds.proxmox_v9x_mod as proxmox_v9x_cloud
 
+AUTHORIZATION = "PVEAPIToken=user!id=secret"
+UPID = "UPID:pve1:0001:0002:0003:qmstart:100:root@pam!salt:"
+
+VMS = [
+    {"vmid": 100, "name": "template", "node": "pve1", "type": "qemu", "status": "stopped"},
+    {"vmid": 101, "name": "web1", "node": "pve2", "type": "qemu", "status": "running"},
+]
+
+
+class FakeClock:
+    """
+    Stand-in for the time module that only advances when sleeping
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
 
 @pytest.fixture
 def configure_loader_modules():
@@ -10,9 +46,496 @@ def configure_loader_modules():
     }
     return {
         proxmox_v9x_cloud: module_globals,
+        proxmox: {
+            "__opts__": {"sock_dir": "/tmp", "transport": "zeromq"},
+            "__active_provider_name__": "my-proxmox:proxmox_v9x",
+            "__utils__": {
+                "cloud.fire_event": MagicMock(),
+                "cloud.filter_event": MagicMock(),
+                "cloud.wait_for_port": MagicMock(return_value=True),
+                "cloud.bootstrap": MagicMock(return_value={}),
+                "cloud.list_nodes_select": salt.utils.cloud.list_nodes_select,
+            },
+        },
     }
 
 
+@pytest.fixture(autouse=True)
+def reset_session():
+    with patch.object(proxmox, "_SESSION", None):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def clear_vm_index():
+    proxmox._VM_INDEX_CACHE.clear()
+    yield
+    proxmox._VM_INDEX_CACHE.clear()
+
+
+@pytest.fixture
+def clock():
+    fake_clock = FakeClock()
+    with patch.object(proxmox, "time", fake_clock):
+        yield fake_clock
+
+
+@pytest.fixture
+def session():
+    """
+    Mocked requests session answering every request with ``{"data": ...}``
+    """
+    response = MagicMock(status_code=200, content=b'{"data": {"key": "value"}}')
+    response.json.return_value = {"data": {"key": "value"}}
+
+    mocked_session = MagicMock()
+    mocked_session.get.return_value = response
+    mocked_session.request.return_value = response
+    with (
+        patch.object(proxmox, "_get_session", return_value=mocked_session),
+        patch.object(proxmox, "_get_provider_api_base", return_value="https://pve:8006/api2/json"),
+        patch.object(proxmox, "_get_provider_authorization", return_value=AUTHORIZATION),
+    ):
+        yield mocked_session
+
+
 def test_replace_this_this_with_something_meaningful():
     assert "this_does_not_exist.please_replace_it" in proxmox_v9x_cloud.__salt__
     assert proxmox_v9x_cloud.__salt__["this_does_not_exist.please_replace_it"]() is True
+
+
+def test_get_session_is_reused_without_authorization():
+    first = proxmox._get_session()
+    second = proxmox._get_session()
+
+    assert second is first
+    # The token is sent per request as the session is shared between providers
+    assert "Authorization" not in first.headers
+
+    adapter = first.get_adapter("https://pve:8006")
+    assert isinstance(adapter, HTTPAdapter)
+    assert adapter.max_retries.total == 3
+
+
+def test_query_sends_authorization_of_active_provider(session):
+    authorizations = {
+        "one:proxmox_v9x": "PVEAPIToken=a!b=one",
+        "two:proxmox_v9x": "PVEAPIToken=c!d=two",
+    }
+    with patch.object(proxmox, "_get_provider_authorization", side_effect=authorizations.get):
+        for provider_name, authorization in authorizations.items():
+            with patch.object(proxmox, "_get_active_provider_name", return_value=provider_name):
+                proxmox._query("GET", "nodes")
+            assert session.get.call_args.kwargs["headers"] == {"Authorization": authorization}
+
+
+def test_provider_settings_are_precomputed_once():
+    settings = {"url": "https://pve:8006", "user": "user", "tokenid": "id", "token": "secret"}
+    cloud_config = MagicMock()
+    cloud_config.get_cloud_config_value.side_effect = lambda key, *_, **__: settings[key]
+
+    proxmox._reset_config_cache()
+    try:
+        with patch.object(proxmox, "config", cloud_config):
+            for _ in range(3):
+                assert proxmox._get_provider_api_base("p") == "https://pve:8006/api2/json"
+                assert proxmox._get_provider_authorization("p") == "PVEAPIToken=user!id=secret"
+    finally:
+        proxmox._reset_config_cache()
+
+    assert cloud_config.is_provider_configured.call_count == 1
+    assert cloud_config.get_cloud_config_value.call_count == 4
+
+
+def test_query_get_uses_session(session):
+    ret = proxmox._query("GET", "nodes")
+
+    assert ret == {"key": "value"}
+    session.get.assert_called_once_with(
+        url="https://pve:8006/api2/json/nodes",
+        headers={"Authorization": AUTHORIZATION},
+        data=None,
+        timeout=10,
+    )
+
+
+def test_query_post_sends_form_data(session):
+    proxmox._query("POST", "nodes/pve1/qemu/100/status/start", {"timeout": 5})
+
+    session.request.assert_called_once_with(
+        method="POST",
+        url="https://pve:8006/api2/json/nodes/pve1/qemu/100/status/start",
+        headers={
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": AUTHORIZATION,
+        },
+        data={"timeout": 5},
+        timeout=10,
+    )
+
+
+def test_lookup_vm_reuses_index_within_ttl():
+    with patch.object(proxmox, "_query", return_value=VMS) as query:
+        assert proxmox._lookup_vm("by_name", "web1")["vmid"] == 101
+        assert proxmox._lookup_vm("by_id", 100)["name"] == "template"
+
+    query.assert_called_once_with("GET", "cluster/resources?type=vm", None)
+
+
+def test_lookup_vm_refreshes_on_miss():
+    new_vm = {"vmid": 102, "name": "web2", "node": "pve1", "type": "qemu"}
+    with patch.object(proxmox, "_query", side_effect=[VMS, VMS + [new_vm]]) as query:
+        proxmox._get_vm_index()
+        # Age the cached index so the miss below isn't served by a fresh fetch
+        proxmox._VM_INDEX_CACHE["my-proxmox:proxmox_v9x"]["ts"] -= 1
+
+        assert proxmox._lookup_vm("by_name", "web2") == new_vm
+
+    assert query.call_count == 2
+
+
+def test_lookup_vm_is_keyed_by_provider():
+    other_vms = [{"vmid": 200, "name": "web1", "node": "other", "type": "qemu"}]
+    with patch.object(proxmox, "_query", side_effect=[VMS, other_vms]):
+        assert proxmox._lookup_vm("by_name", "web1")["node"] == "pve2"
+        with patch.object(proxmox, "__active_provider_name__", "other:proxmox_v9x"):
+            assert proxmox._lookup_vm("by_name", "web1")["node"] == "other"
+        assert proxmox._lookup_vm("by_name", "web1")["node"] == "pve2"
+
+
+def test_clone_invalidates_vm_index():
+    def query(method, path, data=None, **_):
+        if method == "GET":
+            return VMS
+        return UPID
+
+    with patch.object(proxmox, "_query", side_effect=query):
+        assert proxmox.clone(kwargs={"vmid": 100, "newid": 102}) == UPID
+
+    assert not proxmox._VM_INDEX_CACHE
+
+
+def test_poll_intervals_bounds():
+    intervals = proxmox._poll_intervals(0.2, max_interval=10)
+    values = [next(intervals) for _ in range(30)]
+
+    assert 0.2 <= values[0] <= 0.22
+    assert all(0.2 <= value <= 11 for value in values)
+    assert 10 <= values[-1] <= 11
+
+
+def test_poll_intervals_initial_above_max():
+    intervals = proxmox._poll_intervals(15, max_interval=10)
+
+    assert all(15 <= next(intervals) <= 16.5 for _ in range(10))
+
+
+@pytest.mark.parametrize("exitstatus", ["OK", "WARNINGS: 1"])
+def test_wait_for_task_success(clock, exitstatus):
+    responses = [
+        {"status": "running"},
+        {"status": "stopped", "exitstatus": exitstatus},
+    ]
+    with patch.object(proxmox, "_query", side_effect=responses) as query:
+        ret = proxmox._wait_for_task(UPID, timeout=10, interval=1)
+
+    assert ret["exitstatus"] == exitstatus
+    query.assert_called_with("GET", f"nodes/pve1/tasks/{UPID}/status")
+    assert query.call_count == 2
+
+
+def test_wait_for_task_failure(clock):
+    response = {"status": "stopped", "exitstatus": "clone failed: storage full"}
+    with patch.object(proxmox, "_query", return_value=response):
+        with pytest.raises(SaltCloudExecutionFailure, match="storage full"):
+            proxmox._wait_for_task(UPID, timeout=10, interval=1)
+
+
+def test_wait_for_task_timeout(clock):
+    with patch.object(proxmox, "_query", return_value={"status": "running"}) as query:
+        with pytest.raises(SaltCloudExecutionTimeout):
+            proxmox._wait_for_task(UPID, timeout=10, interval=1)
+
+    # No sleep passes the deadline and the task is polled once more at the deadline
+    assert sum(clock.sleeps) == pytest.approx(10)
+    assert query.call_count == len(clock.sleeps) + 1
+
+
+def test_start_already_running_succeeds(clock):
+    response = {"status": "stopped", "exitstatus": "VM 101 already running"}
+    with (
+        patch.object(proxmox, "_set_vm_status", return_value=UPID),
+        patch.object(proxmox, "_query", return_value=response),
+    ):
+        ret = proxmox.start("web1", call="action")
+
+    assert ret["success"] is True
+    assert ret["state"] == "running"
+
+
+def test_start_failed_task_raises(clock):
+    response = {"status": "stopped", "exitstatus": "start failed: no such storage"}
+    with (
+        patch.object(proxmox, "_set_vm_status", return_value=UPID),
+        patch.object(proxmox, "_query", return_value=response),
+    ):
+        with pytest.raises(SaltCloudExecutionFailure, match="no such storage"):
+            proxmox.start("web1", call="action")
+
+
+def test_query_does_not_log_form_data(session, caplog):
+    session.request.side_effect = requests.exceptions.ConnectionError("reset")
+
+    with caplog.at_level(logging.DEBUG, logger=proxmox.__name__):
+        ret = proxmox._query("PUT", "nodes/pve2/qemu/101/config", {"cipassword": "hunter2"})
+
+    assert ret is None
+    assert "Error in PUT query to" in caplog.text
+    assert "hunter2" not in caplog.text
+
+
+def test_query_allow_500_returns_none(session):
+    response = session.get.return_value
+    response.status_code = 500
+    response.raise_for_status.side_effect = requests.exceptions.HTTPError("500")
+
+    assert (
+        proxmox._query("GET", "nodes/pve1/qemu/100/agent/network-get-interfaces", allow_500=True)
+        is None
+    )
+    with pytest.raises(requests.exceptions.HTTPError):
+        proxmox._query("GET", "nodes/pve1/qemu/100/agent/network-get-interfaces")
+
+
+def test_wait_for_ip_polls_agent_once_per_interval(clock):
+    agent_path = "nodes/pve2/qemu/101/agent/network-get-interfaces"
+    agent_responses = [None, {"result": [{"name": "eth0"}]}]
+    calls = []
+
+    def query(method, path, data=None, **kwargs):
+        calls.append((method, path, kwargs))
+        if path == "cluster/resources?type=vm":
+            return VMS
+        return agent_responses.pop(0)
+
+    with patch.object(proxmox, "_query", side_effect=query):
+        ret = proxmox._wait_for_ip("web1", timeout=10, interval=1)
+
+    assert ret == {"result": [{"name": "eth0"}]}
+    assert [call for call in calls if call[1] == agent_path] == [
+        ("GET", agent_path, {"allow_500": True}),
+    ] * 2
+    assert len(clock.sleeps) == 1
+
+
+@pytest.mark.parametrize(
+    "ip_config,expected",
+    [
+        ("name=eth0,bridge=vmbr0,ip=10.0.0.5/24,gw=10.0.0.1", "10.0.0.5/24"),
+        ("ip=192.168.1.2/24", "192.168.1.2/24"),
+        ("ip6=fe80::1/64,ip=1.2.3.4/32", "1.2.3.4/32"),
+        ("ip6=fe80::1/64", None),
+        ("ip=dhcp", "dhcp"),
+        ("name=eth0,gw=10.0.0.1", None),
+    ],
+)
+def test_ip_re(ip_config, expected):
+    match = proxmox._IP_RE.search(ip_config)
+
+    assert (match.group(1) if match else None) == expected
+
+
+def test_parse_ips():
+    vm_config = {
+        "net0": "name=eth0,ip=10.0.0.5/24",
+        "net1": "name=eth1,ip=8.8.8.8/32",
+        "net2": "name=eth2,ip=dhcp",
+        "net3": "name=eth3,ip6=fe80::1/64",
+        "memory": "2048",
+    }
+
+    assert proxmox._parse_ips(vm_config, "lxc") == (["10.0.0.5"], ["8.8.8.8"])
+
+
+def test_create_uses_nextid_without_scanning_the_cluster(clock):
+    calls = []
+
+    def query(method, path, data=None, **_):
+        calls.append((method, path, data))
+        if path == "cluster/resources?type=vm":
+            return VMS
+        if path == "cluster/nextid":
+            return "102"
+        if path.endswith("/status"):
+            return {"status": "stopped", "exitstatus": "OK"}
+        return UPID
+
+    agent = {
+        "result": [
+            {
+                "hardware-address": "aa:bb:cc:dd:ee:ff",
+                "ip-addresses": [{"ip-address-type": "ipv4", "ip-address": "10.0.0.7"}],
+            }
+        ]
+    }
+    vm_ = {"name": "web2", "image": "template", "profile": "web", "driver": "proxmox_v9x"}
+    with (
+        patch.object(proxmox, "_query", side_effect=query),
+        patch.object(proxmox, "start") as start,
+        patch.object(proxmox, "_wait_for_ip", return_value=agent),
+        patch.object(proxmox, "show_instance", return_value={}),
+    ):
+        proxmox.create(vm_)
+
+    assert calls.count(("GET", "cluster/resources?type=vm", None)) == 1
+    clone_calls = [call for call in calls if call[0] == "POST"]
+    assert clone_calls[0][1] == "nodes/pve1/qemu/100/clone"
+    assert clone_calls[0][2]["newid"] == "102"
+    start.assert_called_once_with(call="action", name="web2")
+    assert proxmox.__opts__["ssh_host"] == "10.0.0.7"
+
+
+def test_query_decodes_with_orjson_when_available(session):
+    response = session.get.return_value
+    response.content = b'{"data": [1]}'
+    orjson = MagicMock()
+    orjson.loads.return_value = {"data": [1]}
+
+    with (
+        patch.object(proxmox, "HAS_ORJSON", True),
+        patch.object(proxmox, "orjson", orjson, create=True),
+    ):
+        assert proxmox._query("GET", "nodes") == [1]
+
+    orjson.loads.assert_called_once_with(b'{"data": [1]}')
+    response.json.assert_not_called()
+
+
+def test_query_decodes_with_json_without_orjson(session):
+    with patch.object(proxmox, "HAS_ORJSON", False):
+        assert proxmox._query("GET", "nodes") == {"key": "value"}
+
+    session.get.return_value.json.assert_called_once_with()
+
+
+def test_destroy_looks_up_vm_once(clock):
+    calls = []
+
+    def query(method, path, data=None, **_):
+        calls.append((method, path))
+        if path == "cluster/resources?type=vm":
+            return VMS
+        if path.endswith("/status"):
+            return {"status": "stopped", "exitstatus": "OK"}
+        return UPID
+
+    with patch.object(proxmox, "_query", side_effect=query):
+        proxmox.destroy("web1")
+
+    assert calls == [
+        ("GET", "cluster/resources?type=vm"),
+        ("POST", "nodes/pve2/qemu/101/status/stop"),
+        ("GET", f"nodes/pve1/tasks/{UPID}/status"),
+        ("DELETE", "nodes/pve2/qemu/101"),
+    ]
+    assert not proxmox._VM_INDEX_CACHE
+
+
+def test_show_instance_fetches_one_config():
+    def query(method, path, data=None, **_):
+        if path == "cluster/resources?type=vm":
+            return VMS
+        return {"memory": "2048"}
+
+    with patch.object(proxmox, "_query", side_effect=query) as mocked:
+        ret = proxmox.show_instance("web1", call="action")
+
+    assert ret == dict(VMS[1], config={"memory": "2048"})
+    assert mocked.call_count == 2
+    mocked.assert_called_with("GET", "nodes/pve2/qemu/101/config")
+
+
+def test_show_instance_not_found():
+    with patch.object(proxmox, "_query", return_value=VMS):
+        with pytest.raises(SaltCloudNotFound):
+            proxmox.show_instance("missing", call="action")
+
+
+def test_clone_failed_post_raises():
+    def query(method, path, data=None, **_):
+        if method == "GET":
+            return VMS
+        return None
+
+    with patch.object(proxmox, "_query", side_effect=query):
+        with pytest.raises(SaltCloudExecutionFailure):
+            proxmox.clone(kwargs={"vmid": 100, "newid": 102})
+
+    assert not proxmox._VM_INDEX_CACHE
+
+
+def test_list_nodes_skips_unnamed_resources():
+    unnamed = {"vmid": 103, "node": "pve1", "type": "qemu", "status": "stopped"}
+    vms = [dict(vm, uptime=0, maxcpu=1, maxmem=1024000, maxdisk=0) for vm in VMS + [unnamed]]
+
+    with patch.object(proxmox, "_query", return_value=vms):
+        ret = proxmox.list_nodes()
+
+    assert sorted(ret) == ["template", "web1"]
+
+
+def test_list_nodes_select_skips_config():
+    with patch.dict(proxmox.__opts__, {"query.selection": ["vmid", "status"]}):
+        with patch.object(proxmox, "_query", return_value=VMS) as query:
+            ret = proxmox.list_nodes_select(call="function")
+
+    query.assert_called_once_with("GET", "cluster/resources?type=vm", None)
+    assert ret["web1"] == {"vmid": 101, "status": "running"}
+
+
+def test_list_nodes_select_fetches_config_when_selected():
+    def query(method, path, data=None, **_):
+        if path == "cluster/resources?type=vm":
+            return VMS
+        return {"path": path}
+
+    with patch.dict(proxmox.__opts__, {"query.selection": ["config"]}):
+        with patch.object(proxmox, "_query", side_effect=query) as mocked:
+            ret = proxmox.list_nodes_select(call="function")
+
+    assert mocked.call_count == 3
+    assert ret["web1"] == {"config": {"path": "nodes/pve2/qemu/101/config"}}
+
+
+def test_get_vm_index_failed_fetch_is_not_cached():
+    with patch.object(proxmox, "_query", return_value=None):
+        with pytest.raises(SaltCloudExecutionFailure):
+            proxmox._list_vms()
+
+    assert not proxmox._VM_INDEX_CACHE
+
+
+def test_get_vm_by_name_not_found_is_bounded(clock):
+    with patch.object(proxmox, "_query", return_value=VMS):
+        with pytest.raises(SaltCloudNotFound):
+            proxmox._get_vm_by_name("missing", interval=1)
+
+    assert sum(clock.sleeps) == pytest.approx(60)
+
+
+def test_get_vm_by_name_honors_max(clock):
+    with patch.object(proxmox, "_query", return_value=VMS):
+        with pytest.raises(SaltCloudNotFound):
+            proxmox._get_vm_by_name("missing", interval=5, max=12)
+
+    assert sum(clock.sleeps) == pytest.approx(60)
+    assert clock.sleeps[0] == pytest.approx(5, rel=0.5)
+
+
+def test_wait_for_next_poll_clamps_to_deadline(clock):
+    intervals = iter([5, 5])
+
+    assert proxmox._wait_for_next_poll(intervals, clock.now + 3) is True
+    assert clock.sleeps == [3]
+    assert proxmox._wait_for_next_poll(intervals, clock.now) is False
+    assert clock.sleeps == [3]